@@ -15,27 +15,281 @@ Usage:
     # Plot automatically executes and opens!
 """
 
-import ollama
 import subprocess
 import os
 import re
+import json
+import time
+import uuid
+import queue
+import hashlib
 import platform
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
 
 from log_setup import configure_logging
 logger = configure_logging()
 
+# Imported on first agent construction; pulls in httpx and pydantic
+ollama = None
+
+
+def _read_json_cache(path: Path, default):
+    """Load a JSON cache file, or return default if it's missing or unreadable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable cache %s: %s", path, e)
+    return default
+
+
+def _write_json_cache(path: Path, data):
+    """Replace a JSON cache file, so readers never see a partial write"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not save cache %s: %s", path, e)
+
+
+class _SemanticCache:
+    """
+    Response cache that also matches near-identical prompts.
+
+    Prompts are reduced to their ordered word and symbol tokens, lowercased,
+    without punctuation and without filler words (IGNORABLE_WORDS). Two
+    prompts match only if those token sequences are equal: "Plot y = x^2
+    please" matches "plot y = x^2", but any changed, added or reordered
+    number, symbol or content word ("a = 2" vs "a = 5", "1.5" vs "5.1",
+    "mpg against weight" vs "weight against mpg") is a miss. Entries are
+    scoped by a key (model, temperature, system prompt, conversation so
+    far) and persisted as JSON.
+    """
+
+    IGNORABLE_WORDS = frozenset((
+        'a', 'an', 'the', 'please', 'pls', 'can', 'could', 'would', 'you',
+        'me', 'i', 'for', 'just', 'now', 'hi', 'hello', 'hey', 'thanks',
+        'thank', 'kindly', 'some'
+    ))
+
+    def __init__(self, path: Path, max_entries: int = 256):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (scope, tokens) -> (response, r_code_blocks)
+        self._load()
+
+    @classmethod
+    def _tokens(cls, text: str) -> tuple:
+        tokens = re.findall(r"\w+|[^\w\s.,!?]", text.lower())
+        return tuple(t for t in tokens if t not in cls.IGNORABLE_WORDS)
+
+    def _load(self):
+        try:
+            for scope, tokens, response, r_code_blocks in _read_json_cache(self.path, []):
+                self.entries[(scope, tuple(tokens))] = (response, r_code_blocks)
+        except (TypeError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache %s: %s", self.path, e)
+            self.entries.clear()
+
+    def _save(self):
+        _write_json_cache(self.path, [
+            [scope, tokens, response, r_code_blocks]
+            for (scope, tokens), (response, r_code_blocks) in self.entries.items()
+        ])
+
+    def lookup(self, scope: str, text: str):
+        """Return (response, r_code_blocks) for a matching prompt, or None"""
+        tokens = self._tokens(text)
+        if not tokens:
+            return None
+        return self.entries.get((scope, tokens))
+
+    def add(self, scope: str, text: str, response: str, r_code_blocks: list):
+        tokens = self._tokens(text)
+        if not tokens:
+            return
+        self.entries[(scope, tokens)] = (response, r_code_blocks)
+        self.entries.move_to_end((scope, tokens))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self._save()
+
+
+def _r_string(text: str) -> str:
+    """Quote text as an R string literal"""
+    escaped = (text.replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n').replace('\r', '\\r'))
+    return f'"{escaped}"'
+
+
+def _wrap_r_block(r_code: str, marker: str) -> str:
+    """
+    Wrap a code block so it runs inside tryCatch, auto-prints like Rscript,
+    closes its graphics devices, and ends with a '<<DONE:marker:status>>'
+    line (status 0 on success, 1 on error).
+    """
+    return (
+        "local({\n"
+        "  ok <- tryCatch({\n"
+        f"    for (e in parse(text = {_r_string(r_code)}, keep.source = FALSE)) {{\n"
+        "      v <- withVisible(eval(e, envir = globalenv()))\n"
+        "      if (v$visible) print(v$value)\n"
+        "    }\n"
+        "    TRUE\n"
+        "  }, error = function(e) {\n"
+        "    cat('Error: ', conditionMessage(e), '\\n', sep = '')\n"
+        "    FALSE\n"
+        "  })\n"
+        "  try(graphics.off(), silent = TRUE)\n"
+        f"  cat('\\n<<DONE:{marker}:', if (ok) 0 else 1, '>>\\n', sep = '')\n"
+        "  flush(stdout())\n"
+        "})\n"
+    )
+
+
+class _RSession:
+    """
+    Long-running R process that executes code blocks sent over stdin.
+
+    Each block is evaluated inside tryCatch so an error never ends the
+    session, then a sentinel line with a unique id and exit status marks the
+    end of that block's output. Variables persist between blocks.
+    """
+
+    def __init__(self, cwd: Path):
+        self.proc = subprocess.Popen(
+            ['R', '--no-save', '--no-restore', '--slave'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            cwd=str(cwd)
+        )
+        self._lines = queue.Queue()
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _pump(self):
+        """Move stdout lines onto a queue so reads can time out"""
+        for line in self.proc.stdout:
+            self._lines.put(line)
+        self._lines.put(None)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def submit(self, r_code: str) -> str:
+        """Send a block to R and return the id to collect it with"""
+        job_id = uuid.uuid4().hex
+        self.proc.stdin.write(_wrap_r_block(r_code, job_id))
+        self.proc.stdin.flush()
+        return job_id
+
+    def collect(self, job_id: str, timeout: float):
+        """
+        Read output up to the block's sentinel. Returns (success, output);
+        raises subprocess.TimeoutExpired if R doesn't finish in time.
+        """
+        deadline = time.monotonic() + timeout
+        marker = f"<<DONE:{job_id}:"
+        output = []
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise subprocess.TimeoutExpired(self.proc.args, timeout)
+            if line is None:
+                output.append("R session exited")
+                return False, ''.join(output)
+            if marker in line:
+                status = line[line.index(marker) + len(marker):].split('>>')[0]
+                return status == '0', ''.join(output)
+            output.append(line)
+
+    def close(self):
+        if self.alive():
+            self.proc.kill()
+        self.proc.communicate()
+
+
+class _CodeBlockStream:
+    """
+    Finds fenced code blocks in a streamed response as soon as they close.
+
+    Uses the same pattern as EnhancedOllamaAgent._extract_code_blocks, but
+    only searches the text after the last block found, and only when a new
+    chunk contains a backtick.
+    """
+
+    def __init__(self, pattern: re.Pattern):
+        self._pattern = pattern
+        self._parts = []
+
+    def feed(self, content: str) -> list:
+        """Add a streamed chunk and return any code blocks it completed"""
+        self._parts.append(content)
+        if '`' not in content:
+            return []
+
+        tail = ''.join(self._parts)
+        blocks = []
+        pos = 0
+        while (match := self._pattern.search(tail, pos)):
+            blocks.append(match.group(1))
+            pos = match.end()
+        tail = tail[pos:]
+
+        # Without an open fence only a partial ``` can matter later
+        self._parts = [tail if '```' in tail else tail[-2:]]
+        return blocks
+
+
 class EnhancedOllamaAgent:
     """
     Ollama agent with automatic R code execution and plot display
     """
+
+    # Responses are only cached for near-deterministic sampling
+    CACHE_MAX_TEMPERATURE = 0.3
+
+    # Rough characters-per-token ratio used to size num_keep
+    CHARS_PER_TOKEN = 4
+
+    # Compiled code-fence patterns, keyed by language
+    _CODE_BLOCK_PATTERNS: dict = {}
+
+    R_TIMEOUT_SECONDS = 60
+
+    PLOT_EXTENSIONS = ('.png', '.pdf', '.jpg', '.jpeg', '.svg')
+
+    # Set once no viewer (open/xdg-open) is found, to stop retrying it
+    _viewer_missing = False
+
+    # Generous read timeout: a cold model load can take minutes
+    OLLAMA_TIMEOUT_SECONDS = 600
     
     def __init__(self, 
                  model: str = "llama3", 
                  skills_directory: str = "./skills",
                  auto_execute_r: bool = True,
                  auto_display_plots: bool = True,
-                 save_plots_to: str = "./plots"):
+                 save_plots_to: str = "./plots",
+                 cache_ttl_seconds: float = 3600,
+                 persistent_r: bool = False,
+                 history_window: int = 12,
+                 num_ctx: int = 8192):
+        global ollama
+        if ollama is None:
+            import ollama
+        
         logger.info("Setting up skills")
         # Import the base skills system
         try:
@@ -49,91 +303,248 @@ class EnhancedOllamaAgent:
         self.model = model
         self.conversation_history = []
         self.auto_execute_r = auto_execute_r
-        logger.debug(f"Auto executing R code: {self.auto_execute_r}")
+
+        # At most `history_window` messages are sent verbatim; older ones
+        # are folded into a summary by a background worker, and are still
+        # sent verbatim until that summary is ready
+        self._history_window = history_window
+        self._history_summary = ""
+        self._unsummarized = []
+        self._summary_future = None
+        self._closed = False
+        logger.debug("Auto executing R code: %s", self.auto_execute_r)
         self.auto_display_plots = auto_display_plots
         self.save_plots_to = Path(save_plots_to)
+
+        # The skill text is the same every turn, so build it once and keep
+        # it in front of the prompt where Ollama can reuse its KV cache.
+        # Only do that while it fits in half the context; otherwise send
+        # just the skills selected for each turn.
+        self.num_ctx = num_ctx
+        self._static_system_prefix = self._build_static_system_prefix()
+        self._skills_in_prefix = (
+            len(self._static_system_prefix) // self.CHARS_PER_TOKEN <= num_ctx // 2
+        )
+        if not self._skills_in_prefix:
+            logger.info("Skills exceed half of num_ctx=%d; sending only the active ones", num_ctx)
+            self._static_system_prefix = self._build_static_system_prefix(include_skills=False)
+        self._prefix_num_keep = len(self._static_system_prefix) // self.CHARS_PER_TOKEN
         
         # Create plots directory
         self.save_plots_to.mkdir(exist_ok=True)
+
+        self._semantic_cache = _SemanticCache(self.save_plots_to / '.semcache.json')
+        self.cache_hits = 0
+
+        # One R process reused for every block, instead of an Rscript per
+        # block. Faster, but R variables carry over between blocks.
+        self.persistent_r = persistent_r
+        self._r_session = None
+        if self.persistent_r and self.auto_execute_r:
+            self._get_r_session()
+
+        # Exact-match cache over the full message list (0 disables it)
+        self._cache_ttl_seconds = cache_ttl_seconds
+        self._exact_cache_path = self.save_plots_to / '.exact_cache.json'
+        self._exact_cache = _read_json_cache(self._exact_cache_path, {})
+        if not isinstance(self._exact_cache, dict):
+            self._exact_cache = {}
+        
+        # One client for the agent's lifetime, so its HTTP connection is kept
+        # alive between turns instead of reconnecting for every call
+        self.host = os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434')
+        self._client = ollama.Client(host=self.host, timeout=self.OLLAMA_TIMEOUT_SECONDS)
         
         # Verify Ollama connection
         try:
-            ollama.list()
+            self._client.list()
             print(f"✅ Connected to Ollama (model: {model})")
         except Exception as e:
             print(f"❌ Error connecting to Ollama: {e}")
             print("   Make sure Ollama is running: ollama serve")
     
+    @classmethod
+    def _get_pattern(cls, language: str) -> re.Pattern:
+        """
+        Compile (once) the fence pattern for a language. Matches ```r,
+        ```R and RMarkdown chunks such as ```{r} or ```{r echo=FALSE}.
+        """
+        pattern = cls._CODE_BLOCK_PATTERNS.get(language)
+        if pattern is None:
+            lang = re.escape(language)
+            pattern = re.compile(
+                rf'```(?:{lang}|\{{{lang}\b[^}}\n]*\}})[ \t]*\n(.*?)```',
+                re.DOTALL | re.IGNORECASE
+            )
+            cls._CODE_BLOCK_PATTERNS[language] = pattern
+        return pattern
+
     def _extract_code_blocks(self, text: str, language: str = 'r') -> list:
         """Extract code blocks of a specific language from markdown"""
-        pattern = rf'```{language}\n(.*?)```'
-        matches = re.findall(pattern, text, re.DOTALL | re.IGNORECASE)
-        return matches
+        # Most chat replies have no fences; skip the regex for them
+        if '```' not in text:
+            return []
+        return self._get_pattern(language).findall(text)
     
-    def _execute_r_code(self, r_code: str) -> dict:
-        """Execute R code and return results"""
-        logger.info("Executing R code")
-        script_name = "temp_script.R"
-        script_path = os.path.join(self.save_plots_to, script_name)
+    def _get_r_session(self):
+        """Return the persistent R session, (re)starting it if needed"""
+        if self._r_session is None or not self._r_session.alive():
+            try:
+                self._r_session = _RSession(self.save_plots_to)
+            except FileNotFoundError as fnfe:
+                logger.warning("R not found, falling back to Rscript: %s", fnfe)
+                self.persistent_r = False
+                self._r_session = None
+        return self._r_session
+
+    def _find_plot_files(self, since: float) -> list:
+        """Find plot files modified within 5 seconds of `since` or later"""
+        threshold = since - 5
+        # scandir entries carry cached stat info from the directory read
+        with os.scandir(self.save_plots_to) as entries:
+            return [
+                Path(entry.path) for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and entry.name.lower().endswith(self.PLOT_EXTENSIONS)
+                and entry.stat().st_mtime > threshold
+            ]
+
+    def _start_r_code(self, r_code: str) -> dict:
+        """
+        Launch R on a code block without waiting for it to finish.
+        Pass the returned job to _finish_r_code to collect the results.
+        """
+        # Debug only: this can run while a reply is still being streamed
+        logger.debug("Executing R code")
+        # Plots newer than this (less the 5 second margin) belong to the job
+        job = {'proc': None, 'session': None, 'job_id': None, 'io': None,
+               'output': None, 'started': time.time(), 'result': None}
+
+        if self.persistent_r and self._get_r_session():
+            self.save_plots_to.mkdir(parents=True, exist_ok=True)
+            job['session'] = self._r_session
+            job['job_id'] = self._r_session.submit(r_code)
+            return job
         
         try:
             self.save_plots_to.mkdir(parents=True, exist_ok=True)
-            # Write R code to temp file
-            with open(script_path, 'w') as f:
-                f.write(r_code)
             
-            # Execute with Rscript
-            logger.debug(f"script_path: {str(script_path)}")
-            result = subprocess.run(
-                ['Rscript', str(script_name)],
-                capture_output=True,
+            # Execute with Rscript, reading the code from stdin
+            job['proc'] = subprocess.Popen(
+                ['Rscript', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
                 text=True,
-                timeout=60,
-                cwd=str(self.save_plots_to)  # Run in plots directory
+                cwd=str(self.save_plots_to),  # Run in plots directory
+                start_new_session=True  # So a timeout can kill R's children too
             )
-            
-            # Check for errors
-            if result.returncode != 0:
-                # because Rscript somtimes puts startup errors in stdout:
-                error_message = result.stderr + result.stdout
-                logger.error(f"Return code was not zero. Error: {error_message}")
-                return {
-                    'success': False,
-                    'error': error_message,
-                    'output': "None",
-                    'plot_files': []
-                }
-            
-            # Find generated plot files
-            plot_extensions = ['.png', '.pdf', '.jpg', '.jpeg', '.svg']
-            plot_files = []
-            
-            for file in self.save_plots_to.iterdir():
-                if file.is_file() and file.suffix.lower() in plot_extensions:
-                    # Check if file was created recently (within last 5 seconds)
-                    if (file.stat().st_mtime > (os.path.getmtime(script_path) - 5)):
-                        plot_files.append(file)
-            
-            return {
-                'success': True,
-                'output': result.stdout,
-                'error': None,
-                'plot_files': plot_files
+            # A helper thread feeds the code, sends EOF and drains the
+            # output, so Rscript can run to completion and exit on its own
+            # while the caller keeps streaming
+            proc = job['proc']
+
+            def run_io():
+                job['output'] = proc.communicate(r_code + "\n")
+
+            job['io'] = threading.Thread(target=run_io, daemon=True)
+            job['io'].start()
+        except FileNotFoundError as fnfe:
+            logger.error(fnfe)
+            job['result'] = {
+                'success': False,
+                'error': 'Rscript not found. Make sure R is installed and in PATH.',
+                'output': '',
+                'plot_files': []
             }
-            
+        except Exception as e:
+            logger.error(e)
+            job['result'] = {
+                'success': False,
+                'error': str(e),
+                'output': '',
+                'plot_files': []
+            }
+        
+        return job
+
+    def _finish_r_session_code(self, job: dict) -> dict:
+        """Collect a job that was sent to the persistent R session"""
+        session = job['session']
+        try:
+            # The time limit covers waiting on R, not time spent streaming
+            success, output = session.collect(job['job_id'], self.R_TIMEOUT_SECONDS)
         except subprocess.TimeoutExpired:
-            logger.error("Process timed out")
+            logger.error("R session timed out, restarting it")
+            session.close()
             return {
                 'success': False,
-                'error': 'R script execution timed out (60s limit)',
+                'error': f'R script execution timed out ({self.R_TIMEOUT_SECONDS}s limit)',
                 'output': '',
                 'plot_files': []
             }
-        except FileNotFoundError as fnfe:
-            logger.error(fnfe)
+        
+        if not success:
+            logger.error("R reported an error: %s", output)
             return {
                 'success': False,
-                'error': 'Rscript not found. Make sure R is installed and in PATH.',
+                'error': output,
+                'output': "None",
+                'plot_files': []
+            }
+        
+        return {
+            'success': True,
+            'output': output,
+            'error': None,
+            'plot_files': self._find_plot_files(job['started'])
+        }
+
+    def _rscript_result(self, returncode: int, stdout: str, stderr: str, started: float) -> dict:
+        """Turn a finished Rscript run into a result dict"""
+        # Check for errors
+        if returncode != 0:
+            # because Rscript somtimes puts startup errors in stdout:
+            error_message = stderr + stdout
+            logger.error("Return code was not zero. Error: %s", error_message)
+            return {
+                'success': False,
+                'error': error_message,
+                'output': "None",
+                'plot_files': []
+            }
+        
+        return {
+            'success': True,
+            'output': stdout,
+            'error': None,
+            'plot_files': self._find_plot_files(started)
+        }
+
+    def _finish_r_code(self, job: dict) -> dict:
+        """Wait for a job from _start_r_code and return its results"""
+        if job['result'] is not None:
+            return job['result']
+        if job['session'] is not None:
+            return self._finish_r_session_code(job)
+        
+        proc = job['proc']
+        
+        try:
+            # The time limit covers waiting on R, not time spent streaming
+            job['io'].join(self.R_TIMEOUT_SECONDS)
+            if job['io'].is_alive():
+                raise subprocess.TimeoutExpired(proc.args, self.R_TIMEOUT_SECONDS)
+            stdout, stderr = job['output']
+            return self._rscript_result(proc.returncode, stdout, stderr, job['started'])
+            
+        except subprocess.TimeoutExpired:
+            logger.error("Process timed out")
+            self._kill_rscript(proc)
+            job['io'].join()
+            return {
+                'success': False,
+                'error': f'R script execution timed out ({self.R_TIMEOUT_SECONDS}s limit)',
                 'output': '',
                 'plot_files': []
             }
@@ -145,11 +556,94 @@ class EnhancedOllamaAgent:
                 'output': '',
                 'plot_files': []
             }
-        finally:
-            # Clean up temp script
-            logger.warning(f"NOT removing script: {script_path}")
-#            if script_path.exists():
-#                script_path.unlink()
+
+    def _cancel_r_code(self, job: dict):
+        """Stop a job from _start_r_code whose results are no longer wanted"""
+        if job['session'] is not None:
+            # Blocks can't be interrupted individually; a new session is
+            # started on the next call
+            job['session'].close()
+        elif job['proc']:
+            if job['proc'].poll() is None:
+                self._kill_rscript(job['proc'])
+            job['io'].join()
+
+    @staticmethod
+    def _kill_rscript(proc):
+        """
+        Kill Rscript (a Popen or asyncio process started in its own session)
+        and anything it started, which may hold its pipes open
+        """
+        if os.name == 'posix':
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            proc.kill()
+
+    def _execute_r_code(self, r_code: str) -> dict:
+        """Execute R code and return results"""
+        return self._finish_r_code(self._start_r_code(r_code))
+
+    def _execute_r_blocks(self, r_code_blocks: list) -> list:
+        """
+        Execute all R blocks from one message with a single Rscript start.
+        Each block still gets its own result and an error in one block
+        doesn't stop the others. Plots are detected once for the batch.
+        """
+        if len(r_code_blocks) < 2 or self.persistent_r:
+            return [self._execute_r_code(r_code) for r_code in r_code_blocks]
+        
+        combined, markers = self._combine_r_blocks(r_code_blocks)
+        batch = self._finish_r_code(self._start_r_code(combined))
+        return self._split_r_batch(batch, markers)
+
+    @staticmethod
+    def _combine_r_blocks(r_code_blocks: list) -> tuple:
+        """Wrap blocks into one script; returns (script, per-block markers)"""
+        batch_id = uuid.uuid4().hex
+        markers = [f"{batch_id}-{i}" for i in range(len(r_code_blocks))]
+        combined = ''.join(
+            _wrap_r_block(r_code, marker) for r_code, marker in zip(r_code_blocks, markers)
+        )
+        return combined, markers
+
+    @staticmethod
+    def _split_r_batch(batch: dict, markers: list) -> list:
+        """Split the result of a combined script back into per-block results"""
+        output = batch['output'] if batch['success'] else (batch['error'] or '')
+        
+        results = []
+        for marker in markers:
+            match = re.search(rf'<<DONE:{marker}:(\d)>>\n?', output)
+            if match is None:
+                # R stopped before reaching this block
+                results.append({
+                    'success': False,
+                    'error': output or 'R exited before running this block',
+                    'output': '',
+                    'plot_files': []
+                })
+                output = ''
+                continue
+            
+            block_output, output = output[:match.start()], output[match.end():]
+            if match.group(1) == '0':
+                results.append({
+                    'success': True,
+                    'output': block_output,
+                    'error': None,
+                    'plot_files': batch['plot_files']
+                })
+            else:
+                results.append({
+                    'success': False,
+                    'error': block_output,
+                    'output': "None",
+                    'plot_files': []
+                })
+        return results
     
     def _display_plot(self, plot_path: Path):
         """Open plot in system's default viewer"""
@@ -157,48 +651,135 @@ class EnhancedOllamaAgent:
             print(f"❌ Plot file not found: {plot_path}")
             return False
         
+        if self._viewer_missing:
+            print(f"   You can manually open: {plot_path}")
+            return False
+        
         system = platform.system()
         
+        # Fire and forget: the viewer is detached and never waited on
         try:
-            if system == 'Darwin':  # macOS
-                subprocess.run(['open', str(plot_path)], check=True)
+            if system == 'Darwin':  # macOS; -g keeps focus in the terminal
+                command = ['open', '-g', str(plot_path)]
             elif system == 'Windows':
                 os.startfile(str(plot_path))
+                return True
             else:  # Linux
-                subprocess.run(['xdg-open', str(plot_path)], check=True)
+                command = ['xdg-open', str(plot_path)]
             
+            subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
             return True
+        except FileNotFoundError as fnfe:
+            logger.warning("No plot viewer available, not opening plots: %s", fnfe)
+            self._viewer_missing = True
+            print(f"   You can manually open: {plot_path}")
+            return False
         except Exception as e:
             print(f"⚠️  Could not auto-open plot: {e}")
             print(f"   You can manually open: {plot_path}")
             return False
     
-    def _build_system_prompt(self, relevant_skills: list) -> str:
-        """Build system prompt with active skills"""
-        prompt = "You are a helpful AI assistant"
+    def _build_static_system_prefix(self, include_skills: bool = True) -> str:
+        """Build the system prompt prefix holding every loaded skill"""
+        skills = []
+        if self.skill_manager and include_skills:
+            skills = sorted(self.skill_manager.skills, key=lambda s: s.name)
+
+        parts = ["You are a helpful AI assistant"]
         
-        if relevant_skills:
-            prompt += " with access to specialized skills.\n\n"
-            prompt += "## Active Skills\n\n"
+        if skills:
+            parts.append(" with access to specialized skills.\n\n## Skills\n\n")
             
-            for skill in relevant_skills:
-                prompt += f"### {skill.name}\n\n"
-                prompt += skill.content + "\n\n---\n\n"
+            for skill in skills:
+                parts.extend(("### ", skill.name, "\n\n", skill.content, "\n\n---\n\n"))
         else:
-            prompt += ".\n\n"
+            parts.append(".\n\n")
         
-        return prompt
-    
-    def chat(self, user_message: str, temperature: float = 0.7) -> dict:
+        return ''.join(parts)
+
+    def _build_system_prompt(self, relevant_skills: list) -> str:
         """
-        Chat with automatic R code execution
-        
-        Returns:
-            dict with 'response', 'skills_used', 'r_executed', 'plot_files'
+        Build system prompt with active skills
+
+        The prompt always starts with the same skill prefix and only the short
+        trailing line naming this turn's skills changes, so Ollama can reuse
+        the prefix from its KV cache. That only works while the same model
+        stays loaded with the same options, so avoid changing them
+        mid-conversation.
+
+        When the skills are too large to keep in the prefix, the active
+        skills' full text follows it instead.
+        """
+        if not relevant_skills:
+            return self._static_system_prefix
+
+        if not self._skills_in_prefix:
+            parts = [self._static_system_prefix, "\n## Active Skills\n\n"]
+            for skill in relevant_skills:
+                parts.extend(("### ", skill.name, "\n\n", skill.content, "\n\n---\n\n"))
+            return ''.join(parts)
+
+        names = ', '.join(s.name for s in relevant_skills)
+        return f"{self._static_system_prefix}\n## Activated for this turn: {names}\n"
+
+    def _chat_options(self, temperature: float) -> dict:
+        """Options for ollama.chat, pinning the static prefix in the context"""
+        return {
+            'temperature': temperature,
+            'num_ctx': self.num_ctx,
+            'num_keep': self._prefix_num_keep,
+        }
+
+    def _cache_scope(self, messages: list, temperature: float) -> str:
         """
-        # Select relevant skills
+        Key that separates cached responses by model, sampling, skills and
+        conversation so far: everything in `messages` except the new user
+        message, so follow-ups only match within the same context
+        """
+        context = json.dumps(messages[:-1], sort_keys=True)
+        digest = hashlib.sha256(context.encode()).hexdigest()
+        return f"{self.model}:{temperature}:{digest}"
+
+    def _exact_cache_key(self, messages: list, temperature: float) -> str:
+        """Hash of everything that determines the model's reply"""
+        payload = json.dumps([self.model, messages, temperature], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _exact_cache_get(self, key: str):
+        """Return (response, r_code_blocks) if cached and not expired"""
+        if self._cache_ttl_seconds <= 0:
+            return None
+        entry = self._exact_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, response, r_code_blocks = entry
+        if time.time() - stored_at > self._cache_ttl_seconds:
+            del self._exact_cache[key]
+            return None
+        return response, r_code_blocks
+
+    def _exact_cache_put(self, key: str, response: str, r_code_blocks: list):
+        if self._cache_ttl_seconds <= 0:
+            return
+        now = time.time()
+        self._exact_cache[key] = [now, response, r_code_blocks]
+        # Expired entries are dropped whenever the file is rewritten
+        self._exact_cache = {
+            k: entry for k, entry in self._exact_cache.items()
+            if now - entry[0] <= self._cache_ttl_seconds
+        }
+        _write_json_cache(self._exact_cache_path, self._exact_cache)
+    
+    def _select_skills(self, user_message: str) -> list:
+        """Select the skills relevant to a message and announce them"""
         relevant_skills = []
-        if self.skill_manager:
+        # Nothing to select from: skip tokenizing the message entirely
+        if self.skill_manager and self.skill_manager.skills:
             relevant_skills = self.skill_manager.select_relevant_skills(
                 user_message, max_skills=2
             )
@@ -207,159 +788,296 @@ class EnhancedOllamaAgent:
                 skill_names = [s.name for s in relevant_skills]
                 print(f"🔧 Using skills: {', '.join(skill_names)}")
         
+        return relevant_skills
+
+    def _prepare_chat(self, user_message: str, temperature: float) -> dict:
+        """Select skills, build the messages and cache keys for a chat turn"""
+        relevant_skills = self._select_skills(user_message)
+        
         # Build messages
         system_prompt = self._build_system_prompt(relevant_skills)
         
         messages = [
             {'role': 'system', 'content': system_prompt},
-            *self.conversation_history,
+            *self._history_messages(),
             {'role': 'user', 'content': user_message}
         ]
         
-        # Call Ollama
-        print("💭 Thinking...")
+        use_cache = temperature < self.CACHE_MAX_TEMPERATURE
+        return {
+            'user_message': user_message,
+            'temperature': temperature,
+            'relevant_skills': relevant_skills,
+            'messages': messages,
+            'exact_key': self._exact_cache_key(messages, temperature),
+            'cache_scope': self._cache_scope(messages, temperature) if use_cache else None
+        }
+
+    def _cached_reply(self, turn: dict):
+        """Return (response, r_code_blocks) from either cache, or None"""
+        cached = self._exact_cache_get(turn['exact_key'])
+        if cached is None and turn['cache_scope']:
+            cached = self._semantic_cache.lookup(turn['cache_scope'], turn['user_message'])
+        
+        if cached:
+            self.cache_hits += 1
+            print("⚡ Using cached response")
+        return cached
+
+    def _store_reply(self, turn: dict, assistant_message: str) -> list:
+        """Cache a fresh reply and return its R code blocks"""
+        r_code_blocks = self._extract_code_blocks(assistant_message, 'r')
+        
+        self._exact_cache_put(turn['exact_key'], assistant_message, r_code_blocks)
+        if turn['cache_scope']:
+            self._semantic_cache.add(
+                turn['cache_scope'], turn['user_message'], assistant_message, r_code_blocks
+            )
+        return r_code_blocks
+
+    def _record_turn(self, turn: dict, assistant_message: str) -> dict:
+        """Add the exchange to the history and return the initial result"""
+        # Update conversation history
+        self.conversation_history.append({
+            'role': 'user', 
+            'content': turn['user_message']
+        })
+        self.conversation_history.append({
+            'role': 'assistant', 
+            'content': assistant_message
+        })
+        self._trim_history()
+        
+        return {
+            'response': assistant_message,
+            'skills_used': [s.name for s in turn['relevant_skills']],
+            'r_executed': False,
+            'plot_files': []
+        }
+
+    def _trim_history(self):
+        """
+        Once the history outgrows the window, move all but the newest half
+        window of messages out to be summarized. Trimming well below the
+        limit means a summary runs every few turns rather than every turn.
+        """
+        if self._history_window <= 0 or len(self.conversation_history) <= self._history_window:
+            return
+        # Keep whole user/assistant pairs
+        keep = (self._history_window // 2) & ~1
+        excess = len(self.conversation_history) - keep
+        self._unsummarized.extend(self.conversation_history[:excess])
+        del self.conversation_history[:excess]
+        
+        if self._summary_future is None:
+            self._start_summary()
+
+    def _start_summary(self):
+        """
+        Summarize the evicted messages on a daemon thread, so a slow summary
+        never keeps the interpreter from exiting
+        """
+        evicted = list(self._unsummarized)
+        future = Future()
+        summary = self._history_summary
+        threading.Thread(
+            target=lambda: future.set_result(self._summarize_history(summary, evicted)),
+            daemon=True
+        ).start()
+        self._summary_future = (future, len(evicted))
+
+    def _summarize_history(self, summary: str, evicted: list) -> str:
+        """Fold evicted messages into the running summary (worker thread)"""
+        old_history_text = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+        if summary:
+            old_history_text = f"Earlier summary: {summary}\n{old_history_text}"
         
         try:
-            logger.debug("Calling Ollama")
-            response = ollama.chat(
+            response = self._client.chat(
                 model=self.model,
-                messages=messages,
-                options={'temperature': temperature}
+                messages=[{'role': 'user', 'content': f"Summarize briefly:\n{old_history_text}"}],
+                # A different num_ctx would make Ollama reload the model
+                options={'num_ctx': self.num_ctx}
             )
+            return response['message']['content'].strip()
+        except Exception as e:
+            if not self._closed:
+                logger.warning("History summary failed: %s", e)
+            return summary
+
+    def _history_messages(self) -> list:
+        """
+        Recent history, preceded by the summary of older turns. Evicted
+        messages are sent verbatim until a summary covering them is ready.
+        """
+        if self._summary_future is not None:
+            future, count = self._summary_future
+            if future.done():
+                self._history_summary = future.result()
+                del self._unsummarized[:count]
+                self._summary_future = None
+                # Messages evicted while that summary ran
+                if self._unsummarized:
+                    self._start_summary()
+        
+        messages = [*self._unsummarized, *self.conversation_history]
+        if not self._history_summary:
+            return messages
+        return [
+            {'role': 'system', 'content': f"Summary of earlier conversation: {self._history_summary}"},
+            *messages
+        ]
+
+    def _r_blocks_to_run(self, r_code_blocks: list) -> list:
+        """A reply's R blocks if they should be executed, announced once"""
+        logger.debug("r_code_blocks: %r", r_code_blocks)
+        if not (r_code_blocks and self.auto_execute_r):
+            return []
+        print("\n🔬 R code detected - executing...")
+        return r_code_blocks
+
+    def _report_r_results(self, result: dict, exec_results: list):
+        """Print per-block R results, record them in `result` and open new plots"""
+        plots_to_open = []
+        
+        for i, exec_result in enumerate(exec_results, 1):
+            if exec_result['success']:
+                print(f"✅ R code block {i} executed successfully")
+                
+                if exec_result['output']:
+                    print(f"📊 Output:\n{exec_result['output']}")
+                
+                result['r_executed'] = True
+                # Batched blocks share one plot scan
+                new_plots = [f for f in exec_result['plot_files']
+                             if f not in result['plot_files']]
+                result['plot_files'].extend(new_plots)
+                
+                if self.auto_display_plots:
+                    for plot_file in new_plots:
+                        print(f"💾 Plot saved: {plot_file}")
+                        plots_to_open.append(plot_file)
+            else:
+                print(f"❌ R code block {i} failed:")
+                print(f"   {exec_result['error']}")
+                result['r_error'] = exec_result['error']
+        
+        for plot_file in plots_to_open:
+            print(f"🖼️  Opening plot...")
+            self._display_plot(plot_file)
+
+    @staticmethod
+    def _error_result(error: Exception) -> dict:
+        """Result returned when a chat turn fails"""
+        return {
+            'response': f"Error: {error}",
+            'skills_used': [],
+            'r_executed': False,
+            'plot_files': []
+        }
+    
+    def chat(self, user_message: str, temperature: float = 0.7) -> dict:
+        """
+        Chat with automatic R code execution
+        
+        Returns:
+            dict with 'response', 'skills_used', 'r_executed', 'plot_files'
+        """
+        turn = self._prepare_chat(user_message, temperature)
+        
+        try:
+            cached = self._cached_reply(turn)
+            if cached:
+                assistant_message, r_code_blocks = cached
+            else:
+                # Call Ollama
+                print("💭 Thinking...")
+                logger.debug("Calling Ollama")
+                response = self._client.chat(
+                    model=self.model,
+                    messages=turn['messages'],
+                    options=self._chat_options(temperature)
+                )
+
+                assistant_message = response['message']['content']
+                r_code_blocks = self._store_reply(turn, assistant_message)
             
-            assistant_message = response['message']['content']
-            
-            # Update conversation history
-            self.conversation_history.append({
-                'role': 'user', 
-                'content': user_message
-            })
-            self.conversation_history.append({
-                'role': 'assistant', 
-                'content': assistant_message
-            })
-            
-            # Check for R code
-            r_code_blocks = self._extract_code_blocks(assistant_message, 'r')
-            
-            result = {
-                'response': assistant_message,
-                'skills_used': [s.name for s in relevant_skills],
-                'r_executed': False,
-                'plot_files': []
-            }
-            logger.debug(f"r_code_blocks: {r_code_blocks}")
+            result = self._record_turn(turn, assistant_message)
             # Execute R code if found
-            if r_code_blocks and self.auto_execute_r:
-                print("\n🔬 R code detected - executing...")
-                
-                for i, r_code in enumerate(r_code_blocks, 1):
-                    exec_result = self._execute_r_code(r_code)
-                    
-                    if exec_result['success']:
-                        print(f"✅ R code block {i} executed successfully")
-                        
-                        if exec_result['output']:
-                            print(f"📊 Output:\n{exec_result['output']}")
-                        
-                        result['r_executed'] = True
-                        result['plot_files'].extend(exec_result['plot_files'])
-                        
-                        # Display plots
-                        if exec_result['plot_files'] and self.auto_display_plots:
-                            for plot_file in exec_result['plot_files']:
-                                print(f"💾 Plot saved: {plot_file}")
-                                print(f"🖼️  Opening plot...")
-                                self._display_plot(plot_file)
-                    else:
-                        print(f"❌ R code block {i} failed:")
-                        print(f"   {exec_result['error']}")
-                        result['r_error'] = exec_result['error']
+            r_code_blocks = self._r_blocks_to_run(r_code_blocks)
+            if r_code_blocks:
+                self._report_r_results(result, self._execute_r_blocks(r_code_blocks))
             
             return result
             
         except Exception as e:
-            return {
-                'response': f"Error: {e}",
-                'skills_used': [],
-                'r_executed': False,
-                'plot_files': []
-            }
+            return self._error_result(e)
     
     def stream_chat(self, user_message: str, temperature: float = 0.7) -> dict:
-        """Stream chat with R execution after completion"""
-        # Select relevant skills
-        relevant_skills = []
-        if self.skill_manager:
-            relevant_skills = self.skill_manager.select_relevant_skills(
-                user_message, max_skills=2
-            )
-            
-            if relevant_skills:
-                skill_names = [s.name for s in relevant_skills]
-                print(f"🔧 Using skills: {', '.join(skill_names)}")
-        
-        # Build messages
-        system_prompt = self._build_system_prompt(relevant_skills)
-        
-        messages = [
-            {'role': 'system', 'content': system_prompt},
-            *self.conversation_history,
-            {'role': 'user', 'content': user_message}
-        ]
-        
-        print("💭 Assistant: ", end='', flush=True)
+        """
+        Stream chat with R execution
+
+        Each R block starts running as soon as its closing fence is streamed,
+        overlapping R with the rest of generation. Results are collected
+        after the response completes.
+        """
+        turn = self._prepare_chat(user_message, temperature)
         
-        full_response = ""
+        # Joined once at the end rather than reallocated per chunk
+        response_parts = []
+        r_jobs = []
         
         try:
-            stream = ollama.chat(
-                model=self.model,
-                messages=messages,
-                stream=True,
-                options={'temperature': temperature}
-            )
-            
-            for chunk in stream:
-                content = chunk['message']['content']
-                print(content, end='', flush=True)
-                full_response += content
+            cached = self._cached_reply(turn)
+            print("💭 Assistant: ", end='', flush=True)
+            if cached:
+                response_parts.append(cached[0])
+                print(cached[0], end='', flush=True)
+            else:
+                stream = self._client.chat(
+                    model=self.model,
+                    messages=turn['messages'],
+                    stream=True,
+                    options=self._chat_options(temperature)
+                )
+
+                scanner = _CodeBlockStream(self._get_pattern('r')) if self.auto_execute_r else None
+                for chunk in stream:
+                    content = chunk['message']['content']
+                    print(content, end='', flush=True)
+                    response_parts.append(content)
+
+                    if scanner:
+                        for r_code in scanner.feed(content):
+                            r_jobs.append(self._start_r_code(r_code))
             
             print()  # Newline
+            full_response = ''.join(response_parts)
             
-            # Update history
-            self.conversation_history.append({
-                'role': 'user',
-                'content': user_message
-            })
-            self.conversation_history.append({
-                'role': 'assistant',
-                'content': full_response
-            })
-            
-            # Check for and execute R code
-            result = {
-                'response': full_response,
-                'skills_used': [s.name for s in relevant_skills],
-                'r_executed': False,
-                'plot_files': []
-            }
+            if cached:
+                if self.auto_execute_r:
+                    r_jobs = [self._start_r_code(r_code) for r_code in cached[1]]
+            else:
+                self._store_reply(turn, full_response)
             
-            r_code_blocks = self._extract_code_blocks(full_response, 'r')
+            result = self._record_turn(turn, full_response)
             
-            if r_code_blocks and self.auto_execute_r:
+            if r_jobs:
                 print("\n🔬 R code detected - executing...")
                 
-                for r_code in r_code_blocks:
-                    exec_result = self._execute_r_code(r_code)
+                for job in r_jobs:
+                    exec_result = self._finish_r_code(job)
                     
                     if exec_result['success']:
                         print("✅ Executed successfully")
                         result['r_executed'] = True
-                        result['plot_files'].extend(exec_result['plot_files'])
+                        # Blocks ran concurrently, so they can see each other's plots
+                        new_plots = [f for f in exec_result['plot_files']
+                                     if f not in result['plot_files']]
+                        result['plot_files'].extend(new_plots)
                         
-                        if exec_result['plot_files'] and self.auto_display_plots:
-                            for plot_file in exec_result['plot_files']:
+                        if new_plots and self.auto_display_plots:
+                            for plot_file in new_plots:
                                 print(f"💾 Saved: {plot_file}")
                                 self._display_plot(plot_file)
                     else:
@@ -368,9 +1086,11 @@ class EnhancedOllamaAgent:
             return result
             
         except Exception as e:
+            for job in r_jobs:
+                self._cancel_r_code(job)
             print(f"\n❌ Error: {e}")
             return {
-                'response': full_response or f"Error: {e}",
+                'response': ''.join(response_parts) or f"Error: {e}",
                 'skills_used': [],
                 'r_executed': False,
                 'plot_files': []
@@ -379,6 +1099,10 @@ class EnhancedOllamaAgent:
     def reset(self):
         """Clear conversation history"""
         self.conversation_history = []
+        self._history_summary = ""
+        self._unsummarized = []
+        # A summary still running is simply ignored
+        self._summary_future = None
         print("🔄 Conversation reset")
     
     def list_skills(self):
@@ -388,6 +1112,147 @@ class EnhancedOllamaAgent:
         else:
             print("No skill manager loaded")
 
+    def close(self):
+        """Stop the R session and release the agent's resources"""
+        if self._r_session is not None:
+            self._r_session.close()
+            self._r_session = None
+        # Any in-flight summary runs on a daemon thread and is dropped
+        self._closed = True
+        self._summary_future = None
+        # ollama.Client has no public close; shut its httpx client
+        self._client._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncEnhancedOllamaAgent(EnhancedOllamaAgent):
+    """
+    EnhancedOllamaAgent that waits on Ollama, R and the plot viewer with
+    asyncio instead of blocking.
+
+    Usage:
+        agent = AsyncEnhancedOllamaAgent()
+        result = await agent.achat("Plot y = x² in R")
+
+    chat() still works for synchronous callers: it runs achat() on an event
+    loop owned by the agent, so pooled connections survive between calls.
+    Use one style or the other with a given agent, not both.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_client = ollama.AsyncClient(
+            host=self.host, timeout=self.OLLAMA_TIMEOUT_SECONDS
+        )
+        self._loop = None
+
+    async def achat(self, user_message: str, temperature: float = 0.7) -> dict:
+        """Async version of chat()"""
+        turn = self._prepare_chat(user_message, temperature)
+        
+        try:
+            cached = self._cached_reply(turn)
+            if cached:
+                assistant_message, r_code_blocks = cached
+            else:
+                print("💭 Thinking...")
+                logger.debug("Calling Ollama")
+                response = await self._async_client.chat(
+                    model=self.model,
+                    messages=turn['messages'],
+                    options=self._chat_options(temperature)
+                )
+
+                assistant_message = response['message']['content']
+                r_code_blocks = self._store_reply(turn, assistant_message)
+            
+            result = self._record_turn(turn, assistant_message)
+            r_code_blocks = self._r_blocks_to_run(r_code_blocks)
+            if r_code_blocks:
+                self._report_r_results(result, await self._aexecute_r_blocks(r_code_blocks))
+            
+            return result
+            
+        except Exception as e:
+            return self._error_result(e)
+
+    def chat(self, user_message: str, temperature: float = 0.7) -> dict:
+        """Run achat() to completion for synchronous callers"""
+        if self._loop is None:
+            import asyncio
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.achat(user_message, temperature))
+
+    async def _arun_rscript(self, r_code: str) -> dict:
+        """Async counterpart of _execute_r_code for the Rscript path"""
+        import asyncio
+        logger.debug("Executing R code")
+        started = time.time()
+        self.save_plots_to.mkdir(parents=True, exist_ok=True)
+        
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'Rscript', '-',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=str(self.save_plots_to),
+                start_new_session=True  # So a timeout can kill R's children too
+            )
+        except FileNotFoundError as fnfe:
+            logger.error(fnfe)
+            return {
+                'success': False,
+                'error': 'Rscript not found. Make sure R is installed and in PATH.',
+                'output': '',
+                'plot_files': []
+            }
+        
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate((r_code + "\n").encode()), self.R_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.error("Process timed out")
+            self._kill_rscript(proc)
+            await proc.wait()
+            return {
+                'success': False,
+                'error': f'R script execution timed out ({self.R_TIMEOUT_SECONDS}s limit)',
+                'output': '',
+                'plot_files': []
+            }
+        
+        return self._rscript_result(
+            proc.returncode, stdout.decode(), stderr.decode(), started
+        )
+
+    async def _aexecute_r_blocks(self, r_code_blocks: list) -> list:
+        """Async counterpart of _execute_r_blocks"""
+        if self.persistent_r:
+            import asyncio
+            # The session is fed over a pipe by a reader thread already
+            return await asyncio.to_thread(self._execute_r_blocks, r_code_blocks)
+        if len(r_code_blocks) == 1:
+            return [await self._arun_rscript(r_code_blocks[0])]
+        
+        combined, markers = self._combine_r_blocks(r_code_blocks)
+        return self._split_r_batch(await self._arun_rscript(combined), markers)
+
+    def close(self):
+        """Close the async HTTP client and the agent's event loop"""
+        super().close()
+        if self._loop is not None:
+            # ollama.AsyncClient has no public close; shut its httpx client
+            self._loop.run_until_complete(self._async_client._client.aclose())
+            self._loop.close()
+            self._loop = None
+
 
 def interactive_mode():
     """Interactive CLI with automatic plot display"""
@@ -456,6 +1321,8 @@ def interactive_mode():
             break
         except Exception as e:
             print(f"\n❌ Error: {e}")
+    
+    agent.close()
 
 
 if __name__ == "__main__":
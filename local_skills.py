@@ -11,7 +11,13 @@ Features:
 
 import os
 import json
-import yaml
+import math
+import heapq
+import operator
+import hashlib
+import sqlite3
+from array import array
+from collections import Counter, defaultdict
 from pathlib import Path
 from typing import List, Dict, Optional, Any
 import re
@@ -19,6 +25,115 @@ import re
 from log_setup import configure_logging
 logger = configure_logging()
 
+# Bump when the cached skill fields change, so stale caches are ignored
+SKILL_CACHE_VERSION = 2
+
+
+def _stem(word: str) -> str:
+    """Crude suffix stripping so e.g. plot/plots/plotting/plotted match"""
+    if word.endswith('ies') and len(word) > 4:
+        # summaries -> summary
+        return word[:-3] + 'y'
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            stem = word[:-len(suffix)]
+            # Keep class, status, basis: a lone s after s/u/i isn't a plural.
+            # For -es only strip after s/x/z/ch/sh (classes, boxes); else
+            # just drop the s (tables -> table).
+            if suffix == 's' and stem[-1] in 'sui':
+                break
+            if suffix == 'es' and not stem.endswith(('s', 'x', 'z', 'ch', 'sh')):
+                stem = word[:-1]
+            word = stem
+            # plott -> plot, but keep skill, class
+            if word[-1] == word[-2] and word[-1] not in 'aeioulsz':
+                word = word[:-1]
+            break
+    if word.endswith('e') and len(word) > 4:
+        word = word[:-1]
+    return word
+
+
+def _tokenize(text: str) -> List[str]:
+    """Lowercased, stemmed words longer than 3 characters"""
+    return [_stem(w) for w in re.findall(r'[a-z0-9]+', text.lower()) if len(w) > 3]
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    """Scale a vector to unit length, so dot products are cosines"""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+# math.sumprod (Python 3.12+) is a single C loop; map(operator.mul) is the
+# next best thing without numpy
+_dot = getattr(math, 'sumprod', None) or (lambda a, b: sum(map(operator.mul, a, b)))
+
+
+def _quantize(vector: List[float]) -> tuple:
+    """Symmetric int8 quantization: returns (values, scale), vector ~ values * scale"""
+    scale = max(map(abs, vector)) / 127 or 1.0
+    return array('b', [round(x / scale) for x in vector]), scale
+
+
+def _dequantize(values: array, scale: float) -> List[float]:
+    """Unit-length float vector back from _quantize output"""
+    return _normalize([v * scale for v in values])
+
+
+def _top_k_cosine(query: List[float], vectors: List[List[float]], k: int,
+                  min_similarity: float = -1.0) -> List[tuple]:
+    """
+    The k best (similarity, index) pairs at or above min_similarity, best
+    first. Vectors must be unit length. Plain float lists score faster
+    than slices of an array('f'), which are copied and widened per row.
+    """
+    scores = ((_dot(query, vector), i) for i, vector in enumerate(vectors))
+    # Rows under the threshold never reach the heap
+    return heapq.nlargest(k, (pair for pair in scores if pair[0] >= min_similarity))
+
+
+def _walk_skill_dir(path: Path):
+    """os.walk over a skill directory, skipping hidden dirs and __pycache__"""
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        yield root, dirs, files
+
+
+# Plain scalars PyYAML would not read as strings: numbers, dates, booleans,
+# null, and the value and merge keys
+_YAML_NON_STRING = re.compile(r'[-+.0-9]|(?:yes|no|true|false|on|off|y|n|null|~|=|<<)$', re.I)
+
+# Characters that give a scalar a special meaning when they start it
+_YAML_INDICATORS = '[]{}&*|>!%@`"\'-?:#,'
+
+
+def _parse_simple_frontmatter(frontmatter_str: str) -> Optional[Dict[str, str]]:
+    """
+    Parse frontmatter made only of flat `key: value` lines without PyYAML.
+    Returns None if anything YAML could read differently is present
+    (nesting, lists, quoting, anchors, block scalars, extra colons, a colon
+    not followed by a space, or keys and values YAML would read as
+    numbers, dates, booleans or null).
+    """
+    metadata = {}
+    for line in frontmatter_str.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if line[0].isspace():
+            return None
+        
+        key, sep, rest = line.partition(':')
+        key, value = key.strip(), rest.strip()
+        if (not sep or not rest.startswith(' ') or not key or not value
+                or key[0] in _YAML_INDICATORS or value[0] in _YAML_INDICATORS
+                or ': ' in value or ' #' in value or '\t' in value or value.endswith(':')
+                or _YAML_NON_STRING.match(key) or _YAML_NON_STRING.match(value)):
+            return None
+        metadata[key] = value
+    return metadata
+
 
 class Skill:
     """Represents a single skill with its metadata and content"""
@@ -48,8 +163,11 @@ class Skill:
             frontmatter_str = frontmatter_match.group(1)
             self.content = frontmatter_match.group(2)
             
-            # Parse YAML
-            metadata = yaml.safe_load(frontmatter_str)
+            # Parse YAML, unless it's just simple key: value lines
+            metadata = _parse_simple_frontmatter(frontmatter_str)
+            if metadata is None:
+                import yaml
+                metadata = yaml.safe_load(frontmatter_str)
             self.name = metadata.get('name', self.path.name)
             self.description = metadata.get('description', '')
         else:
@@ -59,23 +177,44 @@ class Skill:
             self.description = ""
         
         # Load reference files
-        for file_path in self.path.rglob('*'):
-            if file_path.is_file() and file_path.name != 'SKILL.md':
+        for root, _, files in _walk_skill_dir(self.path):
+            root_path = Path(root)
+            for name in files:
+                if name == 'SKILL.md':
+                    continue
+                file_path = root_path / name
                 rel_path = file_path.relative_to(self.path)
                 self.reference_files[str(rel_path)] = file_path
     
+    def to_cache(self) -> Dict[str, Any]:
+        """Plain data for the skill cache"""
+        return {
+            'name': self.name,
+            'description': self.description,
+            'content': self.content,
+            'reference_files': list(self.reference_files)
+        }
+    
+    @classmethod
+    def from_cache(cls, skill_path: Path, data: Dict[str, Any]) -> 'Skill':
+        """Rebuild a skill from to_cache() data without reading any files"""
+        skill = cls.__new__(cls)
+        skill.path = skill_path
+        skill.name = data['name']
+        skill.description = data['description']
+        skill.content = data['content']
+        skill.reference_files = {rel: skill_path / rel for rel in data['reference_files']}
+        return skill
+    
     def get_full_context(self) -> str:
         """Get the complete skill context including all reference files"""
-        context = f"# Skill: {self.name}\n\n"
-        context += f"Description: {self.description}\n\n"
-        context += self.content
+        parts = [f"# Skill: {self.name}\n\n", f"Description: {self.description}\n\n", self.content]
         
         if self.reference_files:
-            context += "\n\n## Reference Files\n"
-            for rel_path in self.reference_files:
-                context += f"- {rel_path}\n"
+            parts.append("\n\n## Reference Files\n")
+            parts.extend(f"- {rel_path}\n" for rel_path in self.reference_files)
         
-        return context
+        return ''.join(parts)
     
     def get_summary(self) -> str:
         """Get just the skill name and description for discovery"""
@@ -95,68 +234,276 @@ class Skill:
 
 
 class SkillManager:
-    """Manages skill discovery, selection, and loading"""
+    """
+    Manages skill discovery, selection, and loading
+
+    Skills are selected with BM25 over their names and descriptions. If an
+    Ollama embedding model is given (e.g. "nomic-embed-text"), a cosine
+    ranking over embeddings is fused with it by reciprocal rank.
+    """
+
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+
+    # Reciprocal-rank-fusion constant
+    RRF_K = 60
+
+    # Skills found only by embedding must be at least this similar
+    MIN_EMBEDDING_SIMILARITY = 0.4
+
+    # How many of the most similar skills the embedding ranking considers
+    EMBEDDING_CANDIDATES = 50
+
+    # Generous enough for Ollama to load the embedding model
+    EMBED_TIMEOUT_SECONDS = 30
     
-    def __init__(self, skills_directory: str = "./skills"):
+    def __init__(self, skills_directory: str = "./skills", embedding_model: Optional[str] = None):
         self.skills_directory = Path(skills_directory)
+        self.embedding_model = embedding_model
         self.skills: List[Skill] = []
+        self._cache_path = self.skills_directory / ".skill_cache.json"
+        self._embedding_cache_path = self.skills_directory / ".skill_emb_cache.sqlite"
+        self._embed_client = None
+        self._embeddings = None
+        self._skill_cache = self._load_skill_cache()
         self._discover_skills()
+
+    def _load_skill_cache(self) -> Dict[str, dict]:
+        """Load parsed skills from the last run, keyed by skill directory"""
+        try:
+            with open(self._cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == SKILL_CACHE_VERSION:
+                return data['skills']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Ignoring unreadable skill cache %s: %s", self._cache_path, e)
+        return {}
+
+    def _save_skill_cache(self):
+        try:
+            with open(self._cache_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': SKILL_CACHE_VERSION, 'skills': self._skill_cache}, f)
+        except OSError as e:
+            logger.warning("Could not save skill cache %s: %s", self._cache_path, e)
+    
+    @staticmethod
+    def _skill_mtimes(skill_dir: Path) -> Dict[str, float]:
+        """
+        Modification times of SKILL.md and of every directory in the skill,
+        so adding or removing a reference file at any depth is noticed
+        """
+        mtimes = {'SKILL.md': (skill_dir / "SKILL.md").stat().st_mtime}
+        for root, _, _ in _walk_skill_dir(skill_dir):
+            rel_dir = os.path.relpath(root, skill_dir)
+            mtimes[rel_dir] = os.stat(root).st_mtime
+        return mtimes
     
     def _discover_skills(self):
-        """Discover all skills in the skills directory"""
+        """
+        Discover all skills in the skills directory. A skill is only parsed
+        again when its SKILL.md or any of its directories changed since the
+        last run.
+        """
         if not self.skills_directory.exists():
             print(f"Creating skills directory: {self.skills_directory}")
             self.skills_directory.mkdir(parents=True)
             return
         
+        cache = {}
         # Look for subdirectories containing SKILL.md
-        for skill_dir in self.skills_directory.iterdir():
-            if skill_dir.is_dir() and (skill_dir / "SKILL.md").exists():
+        with os.scandir(self.skills_directory) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                skill_dir = Path(entry.path)
                 try:
-                    skill = Skill(skill_dir)
+                    mtimes = self._skill_mtimes(skill_dir)
+                except FileNotFoundError:
+                    continue
+                
+                try:
+                    cached = self._skill_cache.get(entry.path)
+                    if cached and cached['mtimes'] == mtimes:
+                        skill = Skill.from_cache(skill_dir, cached['skill'])
+                        cache[entry.path] = cached
+                    else:
+                        skill = Skill(skill_dir)
+                        cache[entry.path] = {'mtimes': mtimes, 'skill': skill.to_cache()}
                     self.skills.append(skill)
                     print(f"Loaded skill: {skill.name}")
                 except Exception as e:
                     print(f"Error loading skill from {skill_dir}: {e}")
+        
+        if cache != self._skill_cache:
+            self._skill_cache = cache
+            self._save_skill_cache()
+        
+        self._build_index()
+
+    def _build_index(self):
+        """
+        Precompute BM25 term weights for skill selection as an inverted index
+        (term -> [(skill index, weight)]), and embeddings if enabled. Only
+        names and descriptions are indexed, matching what the model sees
+        before a skill is activated.
+        """
+        docs = [_tokenize(self._skill_text(s)) for s in self.skills]
+        n_docs = len(docs)
+        avg_len = sum(len(doc) for doc in docs) / n_docs if n_docs else 0.0
+        
+        doc_freq = Counter(term for doc in docs for term in set(doc))
+        self._idf = {
+            term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+        
+        k1, b = self.BM25_K1, self.BM25_B
+        self._postings = defaultdict(list)
+        for i, doc in enumerate(docs):
+            length_norm = k1 * (1 - b + b * len(doc) / (avg_len or 1.0))
+            for term, tf in Counter(doc).items():
+                self._postings[term].append((i, tf * (k1 + 1) / (tf + length_norm)))
+        
+        # Unit-length embeddings, one row per skill in self.skills order
+        self._embeddings = None
+        if self.embedding_model and self.skills:
+            try:
+                self._embeddings = self._load_skill_embeddings()
+            except Exception as e:
+                logger.warning("Skill embeddings disabled, using BM25 only: %s", e)
+
+    @staticmethod
+    def _skill_text(skill: Skill) -> str:
+        return f"{skill.name} {skill.description}"
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts with the configured Ollama embedding model"""
+        if self._embed_client is None:
+            import ollama
+            self._embed_client = ollama.Client(timeout=self.EMBED_TIMEOUT_SECONDS)
+        return self._embed_client.embed(model=self.embedding_model, input=texts)['embeddings']
+
+    @property
+    def uses_embeddings(self) -> bool:
+        """True if rankings use query embeddings"""
+        return self._embeddings is not None
+
+    def _load_skill_embeddings(self) -> List[List[float]]:
+        """
+        Normalized embeddings for every skill, read from an on-disk cache
+        keyed by model and text hash. Only new or edited skills are
+        embedded. Vectors are int8-quantized with a per-row scale, both in
+        the cache and before use.
+        """
+        keys = [
+            f"{self.embedding_model}:{hashlib.sha256(self._skill_text(s).encode()).hexdigest()}"
+            for s in self.skills
+        ]
+        try:
+            conn = sqlite3.connect(self._embedding_cache_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS emb_int8(k TEXT PRIMARY KEY, scale REAL, v BLOB)")
+            # Float32 table from before int8 rows
+            conn.execute("DROP TABLE IF EXISTS emb")
+            marks = ",".join("?" * len(keys))
+            cached = {}
+            for k, scale, data in conn.execute(
+                    f"SELECT k, scale, v FROM emb_int8 WHERE k IN ({marks})", keys):
+                values = array('b')
+                values.frombytes(data)
+                cached[k] = (values, scale)
+        except sqlite3.Error as e:
+            logger.warning("Skill embedding cache %s unavailable: %s", self._embedding_cache_path, e)
+            conn, cached = None, {}
+        
+        # Embed every uncached skill in a single request
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        fresh = {}
+        if missing:
+            vectors = self._embed([self._skill_text(self.skills[i]) for i in missing])
+            fresh = {keys[i]: _quantize(_normalize(vector)) for i, vector in zip(missing, vectors)}
+        new_rows = [(key, scale, values.tobytes()) for key, (values, scale) in fresh.items()]
+        
+        # Fresh vectors go through the same int8 round trip as cached ones,
+        # so a skill scores the same on the first run as on later runs
+        cached.update(fresh)
+        embeddings = [_dequantize(*cached[key]) for key in keys]
+        
+        if conn is not None:
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO emb_int8 VALUES (?, ?, ?)", new_rows)
+            except sqlite3.Error as e:
+                logger.warning("Could not save skill embeddings %s: %s", self._embedding_cache_path, e)
+            conn.close()
+        return embeddings
+
+    def _bm25_ranking(self, user_query: str) -> List[int]:
+        """Indexes of skills sharing a term with the query, best first"""
+        scores = defaultdict(float)
+        for term in set(_tokenize(user_query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, weight in self._postings[term]:
+                scores[i] += idf * weight
+        return sorted(scores, key=scores.__getitem__, reverse=True)
+
+    def _embedding_ranking(self, user_query: str, query_embedding: Optional[List[float]],
+                           embed_query: bool) -> List[int]:
+        """Indexes of skills similar enough to the query, best first"""
+        if self._embeddings is None:
+            return []
+        if query_embedding is None:
+            if not embed_query:
+                return []
+            try:
+                query_embedding = self._embed([user_query])[0]
+            except Exception as e:
+                logger.warning("Query embedding failed, using BM25 only: %s", e)
+                return []
+        
+        query = _normalize(query_embedding)
+        top = _top_k_cosine(
+            query, self._embeddings, self.EMBEDDING_CANDIDATES, self.MIN_EMBEDDING_SIMILARITY
+        )
+        return [i for _, i in top]
     
     def get_all_skills_summary(self) -> str:
         """Get a summary of all available skills"""
         if not self.skills:
             return "No skills available."
         
-        summary = "Available Skills:\n\n"
-        for i, skill in enumerate(self.skills, 1):
-            summary += f"{i}. {skill.get_summary()}\n"
-        return summary
+        lines = [f"{i}. {skill.get_summary()}\n" for i, skill in enumerate(self.skills, 1)]
+        return "Available Skills:\n\n" + ''.join(lines)
     
-    def select_relevant_skills(self, user_query: str, max_skills: int = 3) -> List[Skill]:
+    def select_relevant_skills(self, user_query: str, max_skills: int = 3,
+                               query_embedding: Optional[List[float]] = None,
+                               embed_query: bool = True) -> List[Skill]:
         """
-        Select skills relevant to the user's query based on keyword matching.
-        This is a simple implementation - you could use embeddings for better matching.
+        Select skills relevant to the user's query by BM25, fused with
+        embedding similarity when an embedding model is configured.
+
+        Callers that embed the query themselves (e.g. asynchronously) pass
+        it as query_embedding. Otherwise it is embedded here with a
+        blocking call, unless embed_query is False.
         """
-        if not self.skills:
+        if not self.skills or max_skills <= 0:
             return []
         
-        # Score each skill based on keyword overlap
-        scored_skills = []
-        query_lower = user_query.lower()
-        
-        for skill in self.skills:
-            score = 0
-            skill_text = (skill.name + " " + skill.description).lower()
-            
-            # Simple keyword matching
-            words = query_lower.split()
-            for word in words:
-                if len(word) > 3 and word in skill_text:
-                    score += 1
-            
-            if score > 0:
-                scored_skills.append((score, skill))
+        # Reciprocal rank fusion: each ranking adds 1 / (k + rank)
+        fused = defaultdict(float)
+        rankings = (
+            self._bm25_ranking(user_query),
+            self._embedding_ranking(user_query, query_embedding, embed_query)
+        )
+        for ranking in rankings:
+            for rank, i in enumerate(ranking, 1):
+                fused[i] += 1 / (self.RRF_K + rank)
         
-        # Sort by score and return top N
-        scored_skills.sort(reverse=True, key=lambda x: x[0])
-        return [skill for _, skill in scored_skills[:max_skills]]
+        top = heapq.nlargest(max_skills, fused.items(), key=lambda item: item[1])
+        return [self.skills[i] for i, _ in top]
     
     def get_skill_by_name(self, name: str) -> Optional[Skill]:
         """Get a specific skill by name"""
@@ -185,15 +532,16 @@ When a user's request matches one of your available skills, you should reference
 
 """
         
+        parts = [system_prompt]
         if relevant_skills:
-            system_prompt += "## Active Skills\n\n"
+            parts.append("## Active Skills\n\n")
             for skill in relevant_skills:
-                system_prompt += skill.get_full_context() + "\n\n"
-            system_prompt += "---\n\n"
+                parts.extend((skill.get_full_context(), "\n\n"))
+            parts.append("---\n\n")
         
-        system_prompt += "Respond to the user's query using the skills above when relevant.\n"
+        parts.append("Respond to the user's query using the skills above when relevant.\n")
         
-        return system_prompt
+        return ''.join(parts)
     
     def chat(self, user_message: str, use_skills: bool = True) -> Dict[str, Any]:
         """
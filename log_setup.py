@@ -1,29 +1,45 @@
-from colorlog import ColoredFormatter
 import logging
+import sys
 from os import getenv
 
-logger = None
+logger = logging.getLogger("zeta_skills")
 
-def configure_logging(level = "DEBUG"):
-    global logger
-    if not logger:
-        COLORS = {
-            'DEBUG': 'cyan',
-            'INFO': 'green',
-            'WARNING': 'yellow',
-            'ERROR': 'red',
-            'CRITICAL': 'bold_red'
-        }
-        formatter = ColoredFormatter(
-              '%(log_color)s%(asctime)s %(levelname)5s%(reset)s - %(light_black)s%(filename)s:%(lineno)d %(funcName)s%(reset)s - %(log_color)s%(message)s%(reset)s',
-              datefmt='%H:%M:%S',
-              reset=True,
-              log_colors=COLORS
-        )
+def configure_logging(level = None):
+    """
+    Set up the shared logger. The first call defaults the level to
+    $LOG_LEVEL, else INFO; later calls change it only if `level` is given.
+    """
+    if not logger.handlers:
+        if sys.stderr.isatty():
+            # Only import colorlog when the colors will actually be seen
+            from colorlog import ColoredFormatter
+            COLORS = {
+                'DEBUG': 'cyan',
+                'INFO': 'green',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'bold_red'
+            }
+            formatter = ColoredFormatter(
+                  '%(log_color)s%(asctime)s %(levelname)5s%(reset)s - %(light_black)s%(filename)s:%(lineno)d %(funcName)s%(reset)s - %(log_color)s%(message)s%(reset)s',
+                  datefmt='%H:%M:%S',
+                  reset=True,
+                  log_colors=COLORS
+            )
+        else:
+            formatter = logging.Formatter(
+                  '%(asctime)s %(levelname)5s - %(filename)s:%(lineno)d %(funcName)s - %(message)s',
+                  datefmt='%H:%M:%S'
+            )
         # Stream handler
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(formatter)
-        logger= logging.getLogger(__name__)
         logger.addHandler(stream_handler)
+        logger.propagate = False
+        if level is None:
+            level = getenv("LOG_LEVEL", "INFO").upper()
+    # Modules call this bare at import; only an explicit level overrides
+    # whatever was configured first
+    if level is not None:
         logger.setLevel(level)
     return logger
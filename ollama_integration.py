@@ -3,29 +3,145 @@ Complete Ollama Integration Example
 Demonstrates how to use the Local LLM Skills System with Ollama
 """
 
-import ollama
-from pathlib import Path
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from types import SimpleNamespace
 import sys
 
-# Import the skills system (assumes you saved it as local_skills.py)
-# from local_skills import LocalLLMSkillsAgent, SkillManager
+from local_skills import SkillManager
 
-# For this example, we'll include a simplified version inline
+# Imported on first agent construction; pulls in httpx and pydantic
+ollama = None
+
+# Hosts that already answered a health probe in this process
+_VERIFIED_HOSTS = set()
+
+
+def _probe_ollama(host: str, timeout: float = 1.0):
+    """Check that Ollama answers at `host` within `timeout`; raises if not"""
+    if host in _VERIFIED_HOSTS:
+        return
+    client = ollama.Client(host=host, timeout=timeout)
+    try:
+        client.list()
+    finally:
+        client._client.close()
+    _VERIFIED_HOSTS.add(host)
+
+
+def _use_orjson():
+    """
+    Have the ollama client decode streamed NDJSON with orjson when it is
+    installed. The client only calls json.loads, once per streamed chunk.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return
+    client_module = importlib.import_module('ollama._client')
+    client_module.json = SimpleNamespace(loads=orjson.loads, dumps=json.dumps)
+
+
+class _BufferedPrinter:
+    """
+    Prints streamed text in batches: at most every `interval` seconds or
+    once `max_chars` are pending, instead of a write and flush per token.
+    """
+
+    def __init__(self, max_chars: int = 64, interval: float = 0.016):
+        self.max_chars = max_chars
+        self.interval = interval
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str):
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if (self._pending_chars >= self.max_chars
+                or time.monotonic() - self._last_flush >= self.interval):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            sys.stdout.write(''.join(self._pending))
+            self._pending.clear()
+            self._pending_chars = 0
+        sys.stdout.flush()
+        self._last_flush = time.monotonic()
 
 
 class OllamaSkillsAgent:
     """
     Skills-enhanced agent that works with Ollama
+
+    chat() and stream_chat() are coroutines on an ollama.AsyncClient, so
+    several conversations can wait on the server at once.
     """
+
+    # Skill selections are memoized per normalized message
+    SKILL_CACHE_SIZE = 128
+    SKILL_CACHE_TTL_SECONDS = 300
+
+    # Messages (user + assistant) kept in the context; older ones drop off
+    HISTORY_MAX_MESSAGES = 40
+
+    # Start of every system prompt. Ollama reuses the KV cache for a prompt
+    # prefix it has already seen, so this must stay byte-for-byte stable.
+    BASE_PROMPT = """You are a helpful AI assistant with access to specialized skills.
+
+When responding to requests, carefully review any active skills below and follow their instructions precisely.
+"""
+
+    # Rough characters-per-token ratio used to size num_keep
+    CHARS_PER_TOKEN = 4
+
+    # Keep the model (and with it the cached prefix) loaded between turns
+    KEEP_ALIVE = "30m"
+
+    # Connection pool shared by all of the agent's requests
+    MAX_CONNECTIONS = 64
+    KEEPALIVE_EXPIRY_SECONDS = 60
     
-    def __init__(self, model: str = "llama3", skills_directory: str = "./skills"):
+    # Past this, skills are picked by BM25 alone for that message
+    QUERY_EMBED_TIMEOUT_SECONDS = 10
+    
+    def __init__(self, model: str = "llama3", skills_directory: str = "./skills",
+                 embedding_model: str = None):
+        global ollama
+        if ollama is None:
+            import ollama
+        
         self.model = model
-        self.skill_manager = SkillManager(skills_directory)
-        self.conversation_history = []
+        self.skill_manager = SkillManager(skills_directory, embedding_model=embedding_model)
+        self.conversation_history = deque(maxlen=self.HISTORY_MAX_MESSAGES)
+        _use_orjson()
+        # One pooled client for the agent's lifetime: concurrent chats share
+        # kept-alive connections instead of connecting per request
+        import httpx
+        self.host = os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434')
+        self._client = ollama.AsyncClient(
+            host=self.host,
+            limits=httpx.Limits(
+                max_connections=self.MAX_CONNECTIONS,
+                max_keepalive_connections=self.MAX_CONNECTIONS,
+                keepalive_expiry=self.KEEPALIVE_EXPIRY_SECONDS
+            )
+        )
+        self._skill_cache = OrderedDict()
+        self._prompt_cache = {}
+        self._base_num_keep = len(self.BASE_PROMPT) // self.CHARS_PER_TOKEN
         
-        # Verify Ollama is available
+        # Verify Ollama is available, without hanging on an unresponsive
+        # server or re-probing for every agent
         try:
-            ollama.list()
+            _probe_ollama(self.host)
             print(f"✅ Connected to Ollama")
             print(f"📦 Using model: {model}")
         except Exception as e:
@@ -33,58 +149,108 @@ class OllamaSkillsAgent:
             print("Make sure Ollama is running: ollama serve")
             sys.exit(1)
     
+    async def _embed_query(self, user_message: str):
+        """
+        Embed a message on the pooled async client, so a slow embedding
+        never blocks the event loop. Returns None on failure or timeout.
+        """
+        try:
+            response = await asyncio.wait_for(
+                self._client.embed(model=self.skill_manager.embedding_model, input=[user_message]),
+                self.QUERY_EMBED_TIMEOUT_SECONDS
+            )
+            return response['embeddings'][0]
+        except Exception as e:
+            print(f"⚠️  Query embedding failed, using BM25 only: {e!r}")
+            return None
+    
+    async def select_skills(self, user_message: str):
+        """Relevant skills for a message, from an LRU cache with a TTL"""
+        key = hashlib.sha256(user_message.strip().lower().encode()).hexdigest()
+        now = time.monotonic()
+        
+        cached = self._skill_cache.get(key)
+        if cached and now - cached[1] < self.SKILL_CACHE_TTL_SECONDS:
+            self._skill_cache.move_to_end(key)
+            return cached[0]
+        
+        query_embedding = None
+        if self.skill_manager.uses_embeddings:
+            query_embedding = await self._embed_query(user_message)
+            if query_embedding is None:
+                # Don't cache a BM25-only fallback
+                return self.skill_manager.select_relevant_skills(
+                    user_message, max_skills=2, embed_query=False
+                )
+        skills = self.skill_manager.select_relevant_skills(
+            user_message, max_skills=2, query_embedding=query_embedding
+        )
+        self._skill_cache[key] = (skills, now)
+        self._skill_cache.move_to_end(key)
+        if len(self._skill_cache) > self.SKILL_CACHE_SIZE:
+            self._skill_cache.popitem(last=False)
+        return skills
+    
     def build_system_prompt(self, relevant_skills):
         """Build enhanced system prompt with skills"""
-        base_prompt = """You are a helpful AI assistant with access to specialized skills.
-
-When responding to requests, carefully review any active skills below and follow their instructions precisely.
-"""
+        # Keyed on content too, so a reloaded skill gets a fresh prompt
+        key = tuple((skill.name, skill.content) for skill in relevant_skills)
+        cached = self._prompt_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        parts = [self.BASE_PROMPT]
         
         if relevant_skills:
-            base_prompt += "\n## ACTIVE SKILLS\n\n"
+            parts.append("\n## ACTIVE SKILLS\n\n")
             for skill in relevant_skills:
-                base_prompt += f"### {skill.name}\n\n"
-                base_prompt += skill.content + "\n\n"
-                base_prompt += "---\n\n"
+                parts.extend((f"### {skill.name}\n\n", skill.content, "\n\n---\n\n"))
         
-        return base_prompt
+        prompt = self._prompt_cache[key] = ''.join(parts)
+        return prompt
     
-    def chat(self, user_message: str, temperature: float = 0.7, use_skills: bool = True):
-        """
-        Send a message and get a response with skill enhancement
-        """
+    async def _build_messages(self, user_message: str, use_skills: bool):
+        """Select skills and build the message list; returns (messages, skills)"""
         relevant_skills = []
         
         # Discover and load relevant skills
         if use_skills:
-            relevant_skills = self.skill_manager.select_relevant_skills(user_message, max_skills=2)
+            relevant_skills = await self.select_skills(user_message)
             
             if relevant_skills:
                 skill_names = [s.name for s in relevant_skills]
                 print(f"\n🔧 Activating skills: {', '.join(skill_names)}")
         
-        # Build messages with system prompt
+        # Build messages with system prompt (cached per skill set)
         system_prompt = self.build_system_prompt(relevant_skills)
         
-        messages = [
-            {'role': 'system', 'content': system_prompt},
-            *self.conversation_history,
-            {'role': 'user', 'content': user_message}
-        ]
+        messages = [{'role': 'system', 'content': system_prompt}]
+        messages.extend(self.conversation_history)
+        messages.append({'role': 'user', 'content': user_message})
+        return messages, relevant_skills
+    
+    async def chat(self, user_message: str, temperature: float = 0.7, use_skills: bool = True):
+        """
+        Send a message and get a response with skill enhancement
+        """
+        messages, relevant_skills = await self._build_messages(user_message, use_skills)
         
         # Call Ollama
         try:
             print(f"\n💭 Thinking...")
             
-            response = ollama.chat(
+            response = await self._client.chat(
                 model=self.model,
                 messages=messages,
                 options={
                     'temperature': temperature,
-                }
+                    'num_keep': self._base_num_keep,
+                },
+                keep_alive=self.KEEP_ALIVE,
+                stream=False
             )
             
-            assistant_message = response['message']['content']
+            assistant_message = response.message.content
             
             # Update conversation history
             self.conversation_history.append({'role': 'user', 'content': user_message})
@@ -103,44 +269,37 @@ When responding to requests, carefully review any active skills below and follow
                 'model': self.model
             }
     
-    def stream_chat(self, user_message: str, use_skills: bool = True):
+    async def stream_chat(self, user_message: str, use_skills: bool = True):
         """
         Stream the response for real-time output
         """
-        relevant_skills = []
-        
-        if use_skills:
-            relevant_skills = self.skill_manager.select_relevant_skills(user_message, max_skills=2)
-            
-            if relevant_skills:
-                skill_names = [s.name for s in relevant_skills]
-                print(f"\n🔧 Activating skills: {', '.join(skill_names)}")
-        
-        system_prompt = self.build_system_prompt(relevant_skills)
-        
-        messages = [
-            {'role': 'system', 'content': system_prompt},
-            *self.conversation_history,
-            {'role': 'user', 'content': user_message}
-        ]
+        messages, relevant_skills = await self._build_messages(user_message, use_skills)
         
         print(f"\n💭 Assistant: ", end='', flush=True)
         
-        full_response = ""
+        # Joined once at the end rather than reallocated per chunk
+        response_parts = []
         
         try:
-            stream = ollama.chat(
+            stream = await self._client.chat(
                 model=self.model,
                 messages=messages,
+                options={'num_keep': self._base_num_keep},
+                keep_alive=self.KEEP_ALIVE,
                 stream=True
             )
             
-            for chunk in stream:
-                content = chunk['message']['content']
-                print(content, end='', flush=True)
-                full_response += content
+            printer = _BufferedPrinter()
+            try:
+                async for chunk in stream:
+                    content = chunk.message.content
+                    printer.write(content)
+                    response_parts.append(content)
+            finally:
+                printer.flush()
             
             print()  # New line after streaming
+            full_response = ''.join(response_parts)
             
             # Update history
             self.conversation_history.append({'role': 'user', 'content': user_message})
@@ -160,32 +319,32 @@ When responding to requests, carefully review any active skills below and follow
     
     def reset(self):
         """Clear conversation history"""
-        self.conversation_history = []
+        self.conversation_history.clear()
         print("🔄 Conversation reset")
     
     def list_skills(self):
         """Show all available skills"""
         print(self.skill_manager.get_all_skills_summary())
 
-
-# Simple SkillManager stub for this example
-class SkillManager:
-    def __init__(self, skills_directory):
-        self.skills_directory = Path(skills_directory)
-        self.skills = []
-        print(f"📁 Skills directory: {self.skills_directory}")
-    
-    def select_relevant_skills(self, query, max_skills=2):
-        return []  # Simplified - use full implementation from main file
-    
-    def get_all_skills_summary(self):
-        return "Use the full implementation to load skills"
+    async def close(self):
+        """Close the HTTP client"""
+        # ollama.AsyncClient has no public close; shut its httpx client
+        await self._client._client.aclose()
 
 
 def interactive_mode():
     """
     Interactive CLI for chatting with Ollama + Skills
+
+    The prompt loop is synchronous so Ctrl-C behaves normally; each reply
+    runs on one shared event loop, which keeps the client's pooled
+    connections alive between turns.
     """
+    with asyncio.Runner() as runner:
+        _interactive_session(runner)
+
+
+def _interactive_session(runner: asyncio.Runner):
     print("=" * 70)
     print("🤖 Ollama Skills Agent - Interactive Mode")
     print("=" * 70)
@@ -199,6 +358,12 @@ def interactive_mode():
     # Initialize agent
     agent = OllamaSkillsAgent(model="llama3", skills_directory="./skills")
     
+    # Load the model while the user types the first message
+    if os.environ.get("SKILLS_WARMUP") == "1":
+        threading.Thread(
+            target=_preload_model, args=(agent.model, agent.KEEP_ALIVE), daemon=True
+        ).start()
+    
     while True:
         try:
             user_input = input("\n👤 You: ").strip()
@@ -230,7 +395,9 @@ def interactive_mode():
                     continue
             
             # Stream the response
-            result = agent.stream_chat(user_input)
+            # A Ctrl-C while streaming cancels the reply and surfaces here
+            # as KeyboardInterrupt
+            result = runner.run(agent.stream_chat(user_input))
             
             if result['skills_used']:
                 print(f"\n✨ Skills used: {', '.join(result['skills_used'])}")
@@ -240,9 +407,11 @@ def interactive_mode():
             break
         except Exception as e:
             print(f"\n❌ Error: {e}")
+    
+    runner.run(agent.close())
 
 
-def example_usage():
+async def example_usage():
     """
     Programmatic usage example
     """
@@ -260,23 +429,69 @@ def example_usage():
         "Write a Python function to calculate fibonacci numbers"
     ]
     
-    for query in queries:
+    # The queries are independent, so send them together and let Ollama
+    # serve them in parallel (up to its OLLAMA_NUM_PARALLEL slots)
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(agent.chat(query)) for query in queries]
+    
+    for query, task in zip(queries, tasks):
+        result = task.result()
         print(f"\n{'=' * 70}")
         print(f"Query: {query}")
         print('=' * 70)
         
-        result = agent.chat(query)
         print(f"\n{result['response']}")
         
         if result['skills_used']:
             print(f"\n✨ Skills used: {', '.join(result['skills_used'])}")
         
         print()
+    
+    await agent.close()
+
+
+def _preload_model(model: str, keep_alive: str):
+    """Have Ollama load the model into memory; a chat with no messages does that"""
+    try:
+        ollama.chat(model=model, messages=[], keep_alive=keep_alive)
+    except Exception as e:
+        print(f"⚠️  Could not preload {model}: {e}")
+
+
+def warmup(model: str = "llama3", skills_directory: str = "./skills",
+           embedding_model: str = None):
+    """
+    Do the slow first-run work ahead of time: parse and index the skills
+    (filling the on-disk skill caches) and load the model into Ollama.
+    Pass the same embedding_model the agent will use, so its skill
+    embeddings are cached too.
+    """
+    global ollama
+    if ollama is None:
+        import ollama
+    
+    print("🔥 Warming up...")
+    start = time.monotonic()
+    SkillManager(skills_directory, embedding_model=embedding_model)
+    _preload_model(model, OllamaSkillsAgent.KEEP_ALIVE)
+    print(f"✅ Warm-up done in {time.monotonic() - start:.1f}s")
 
 
 if __name__ == "__main__":
     # Run interactive mode by default
     # Uncomment example_usage() to see programmatic examples
+    # `python ollama_integration.py warmup [model] [--embedding-model M]
+    # [--skills-dir D]` preloads the model and skills
+    
+    if sys.argv[1:2] == ["warmup"]:
+        import argparse
+        parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} warmup")
+        parser.add_argument("model", nargs="?", default="llama3")
+        parser.add_argument("--embedding-model", default=None)
+        parser.add_argument("--skills-dir", default="./skills")
+        args = parser.parse_args(sys.argv[2:])
+        warmup(args.model, args.skills_dir, args.embedding_model)
+        sys.exit(0)
     
     interactive_mode()
-    # example_usage()
\ No newline at end of file
+    # asyncio.run(example_usage())
\ No newline at end of file